@@ -1,134 +1,936 @@
 # main.py - FastAPI app for YouTube video summarization with captions fallback
 from dotenv import load_dotenv  # Load .env into os.environ
-import os, re, uuid, time, requests
-from fastapi import FastAPI, Body, Query, HTTPException
-from fastapi.responses import JSONResponse
+import os, re, time, asyncio, logging, secrets, weakref, contextlib, multiprocessing, httpx, orjson
+import redis.asyncio as redis
+from cachetools import TTLCache
+from fastapi import FastAPI, Body, Query, HTTPException, Request
+from fastapi.responses import ORJSONResponse, Response
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from youtube_transcript_api import YouTubeTranscriptApi  # Fallback caption scraping
-import yt_dlp  # Python API for downloading audio
+import yt_dlp  # Python API for resolving audio stream URLs
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Shared async HTTP client: keep-alive pool reused across YouTube/AssemblyAI calls.
+# The transport retries failed connects; get_with_retry covers retryable statuses.
+client = httpx.AsyncClient(
+    timeout=30,
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    ),
+)
+
+RETRY_STATUSES = {429, 502, 503, 504}
+
+async def get_with_retry(url: str, retries: int = 3, backoff: float = 0.5, **kwargs) -> httpx.Response:
+    # Only idempotent GETs are retried; uploads/job creation are not replayable
+    for attempt in range(retries + 1):
+        response = await client.get(url, **kwargs)
+        if response.status_code not in RETRY_STATUSES or attempt == retries:
+            return response
+        await asyncio.sleep(backoff * 2 ** attempt)
+
+# Optional Redis cache (set REDIS_URL); run it with maxmemory-policy allkeys-lfu
+REDIS_URL = os.getenv("REDIS_URL")
+r = None
+
+# yt-dlp extraction runs in a small process pool instead of a fresh
+# interpreter per job; also bounds how many extractions run at once
+YTDLP_WORKERS = int(os.getenv("YTDLP_WORKERS", "4"))
+ydl_pool = None
+
+@app.on_event("startup")
+async def connect_redis():
+    global r
+    if REDIS_URL:
+        r = redis.from_url(REDIS_URL)
+
+def new_ydl_pool() -> ProcessPoolExecutor:
+    # spawn, not fork: the parent already has event-loop and to_thread threads
+    return ProcessPoolExecutor(max_workers=YTDLP_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+@app.on_event("startup")
+async def start_ydl_pool():
+    global ydl_pool
+    ydl_pool = new_ydl_pool()
+
+async def run_in_ydl_pool(fn, *args):
+    global ydl_pool
+    loop = asyncio.get_running_loop()
+    pool = ydl_pool
+    try:
+        return await loop.run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed) and took the pool with it; replace
+        # it once (unless a concurrent caller already has) and retry
+        if ydl_pool is pool:
+            ydl_pool = new_ydl_pool()
+            pool.shutdown(wait=False, cancel_futures=True)
+        return await loop.run_in_executor(ydl_pool, fn, *args)
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await client.aclose()
+    if r is not None:
+        await r.aclose()
+    if ydl_pool is not None:
+        ydl_pool.shutdown(wait=False, cancel_futures=True)
 
 # Read API keys
 YOUTUBE_API_KEY    = os.getenv("YOUTUBE_API_KEY")
 ASSEMBLYAI_API_KEY = os.getenv("ASSEMBLYAI_API_KEY")
 
+# Webhook delivery: AssemblyAI calls back PUBLIC_BASE_URL/webhooks/assemblyai/<secret>
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+PUBLIC_BASE_URL      = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+
+# Finished AssemblyAI jobs (tx:transcript:{id}) and the job -> video map;
+# the TTLCaches stand in for Redis when it is off
+TRANSCRIPT_TTL = 86400
+transcripts = TTLCache(maxsize=1_000, ttl=TRANSCRIPT_TTL)
+transcript_videos = TTLCache(maxsize=10_000, ttl=TRANSCRIPT_TTL)
+
+# Completed transcripts per video (tx:done:{video_id}): repeat requests skip
+# yt-dlp and AssemblyAI entirely
+TX_DONE_TTL = 30 * 86400
+done_transcripts = TTLCache(maxsize=1_000, ttl=TX_DONE_TTL)
+
+# /transcribe single-flight: lock while downloading/uploading (renewed until
+# the upload finishes), then map the video to its job (tx:result:{video_id})
+# until the job is finalized so later requests join it instead of resubmitting
+TX_LOCK_TTL = 600
+inflight_submissions = {}
+active_jobs = TTLCache(maxsize=10_000, ttl=TRANSCRIPT_TTL)
+
+# Jobs awaiting a result (tx:pending, scored by submit time; this dict when
+# Redis is off). Without webhooks the poller is the only way results arrive,
+# so it sweeps often and checks every pending job.
+pending_jobs = {}
+stale_job_poller = None
+TX_POLL_INTERVAL = int(os.getenv("TX_POLL_INTERVAL", "300" if WEBHOOK_SECRET_TOKEN and PUBLIC_BASE_URL else "10"))
+TX_STALE_AFTER   = int(os.getenv("TX_STALE_AFTER", "300" if WEBHOOK_SECRET_TOKEN and PUBLIC_BASE_URL else "0"))
+
+# Skip the audio download entirely whenever captions exist
+PREFER_CAPTIONS = os.getenv("PREFER_CAPTIONS", "false").lower() == "true"
+
+def format_transcript(status_resp: dict) -> dict:
+    return {
+        "transcript": status_resp.get("text"),
+        "paragraphs": status_resp.get("paragraphs", []),
+        "speaker_labels": status_resp.get("utterances", []),
+        "source": "assemblyai_audio"
+    }
+
+# watch?v=, youtu.be/, /shorts/, /embed/ and /live/ URLs; the id stops at ?, & or #
+VIDEO_ID_RE = re.compile(r"(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([\w-]+)")
+
+# Cache policy for YouTube metadata: served fresh for an hour, then
+# stale-while-revalidate until the key expires after a day
+METADATA_TTL   = 86400
+METADATA_FRESH = 3600
+
+# Captions never change for a video: keep a week, revalidate after an hour
+CAPTIONS_TTL   = 7 * 86400
+CAPTIONS_FRESH = 3600
+
+# In-process fallback when REDIS_URL is unset: per-process memory is scarcer,
+# so metadata lives six hours and captions a day (both past their fresh
+# window, so stale-while-revalidate still applies)
+META_CACHE = TTLCache(maxsize=10_000, ttl=6 * 3600)
+CAPS_CACHE = TTLCache(maxsize=10_000, ttl=86400)
+
+# Cache-fallback mode: keep a long-lived last-known-good copy of metadata and
+# captions (yt:meta:stale:*, yt:caps:stale:*) and serve it, marked
+# X-Cache: stale, when YouTube is unreachable
+ALLOW_STALE = os.getenv("ALLOW_STALE", "false").lower() == "true"
+STALE_TTL   = 30 * 86400
+STALE_CACHE = TTLCache(maxsize=10_000, ttl=STALE_TTL)
+
+async def remember_stale(key: str, value):
+    if ALLOW_STALE:
+        await kv_set(key, value, STALE_TTL, STALE_CACHE)
+
+def mark_stale(response):
+    if response is not None:
+        response.headers["X-Cache"] = "stale"
+
+# One upstream fetch per cache key at a time (cache stampede protection)
+fill_locks = weakref.WeakValueDictionary()
+
+def fill_lock(key: str) -> asyncio.Lock:
+    lock = fill_locks.get(key)
+    if lock is None:
+        lock = fill_locks[key] = asyncio.Lock()
+    return lock
+
+async def claim_fill_locks(keys: list) -> list:
+    """
+    Take the fill locks for a background revalidation, skipping keys already
+    being fetched. Sorted, like foreground fills, so the two can't deadlock.
+    """
+    claimed = []
+    for key in sorted(keys):
+        lock = fill_lock(key)
+        if not lock.locked():
+            await lock.acquire()
+            claimed.append((key, lock))
+    return claimed
+
+async def release_after(locks: list, coro):
+    try:
+        await coro
+    finally:
+        for lock in locks:
+            lock.release()
+
+def local_cache(key: str) -> TTLCache:
+    return CAPS_CACHE if key.startswith("yt:caps:") else META_CACHE
+
+# Strong refs to fire-and-forget refresh tasks so they aren't garbage collected
+background_tasks = set()
+
+def background_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    # Retrieve the exception so a failed refresh is logged once, not as
+    # "Task exception was never retrieved"
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Background refresh failed: %r", task.exception())
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_done)
+    return task
+
+async def cache_get(key: str):
+    """Return (value, is_stale) for a cached entry, or None on miss."""
+    if r is None:
+        entry = local_cache(key).get(key)
+    else:
+        try:
+            raw = await r.get(key)
+        except redis.RedisError:
+            return None
+        entry = None if raw is None else orjson.loads(raw)
+    if entry is None:
+        return None
+    return entry["value"], time.time() > entry["fresh_until"]
+
+async def cache_set(key: str, value, ttl: int, fresh_for: int):
+    entry = {"value": value, "fresh_until": time.time() + fresh_for}
+    if r is None:
+        local_cache(key)[key] = entry
+        return
+    try:
+        await r.set(key, orjson.dumps(entry), ex=ttl)
+    except redis.RedisError:
+        pass
+
+def join_segments(segments: list) -> str:
+    # A list (not a generator) lets str.join size the result in one pass
+    return " ".join([seg['text'] for seg in segments])
+
+# Optionally pin the YouTube player client(s) so yt-dlp skips probing every
+# client per video, e.g. YTDLP_PLAYER_CLIENTS=visionos. Unset leaves the choice
+# to yt-dlp: its defaults change between releases and some clients need a JS
+# runtime for the n-challenge, which this service does not provision.
+YTDLP_PLAYER_CLIENTS = [c for c in os.getenv("YTDLP_PLAYER_CLIENTS", "").split(",") if c]
+
+YDL_OPTS = {
+    # Progressive https only: download_chunks streams info["url"] as one file,
+    # which for DASH/HLS formats would be a manifest, not audio
+    'format': 'bestaudio[ext=m4a][protocol=https]',
+    'quiet': True,
+    'noplaylist': True,
+}
+if YTDLP_PLAYER_CLIENTS:
+    YDL_OPTS['extractor_args'] = {'youtube': {'player_client': YTDLP_PLAYER_CLIENTS}}
+
+# Per-worker YoutubeDL, built on first use and reused across jobs
+ydl = None
+
+def resolve_audio(video_id: str) -> tuple:
+    """
+    Runs in ydl_pool: return (direct audio URL, HTTP headers yt-dlp would send,
+    ranged-request size yt-dlp would use or None).
+    """
+    global ydl
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL(YDL_OPTS)
+    info = ydl.extract_info(f"https://youtu.be/{video_id}", download=False)
+    if info.get("protocol") not in ("https", "http"):
+        raise Exception(f"No progressive audio format (got {info.get('protocol')})")
+    http_chunk_size = (info.get("downloader_options") or {}).get("http_chunk_size")
+    return info["url"], info.get("http_headers", {}), http_chunk_size
+
+async def download_chunks(url: str, headers: dict, http_chunk_size: int = None, chunk_size: int = 1 << 20):
+    """
+    Stream the audio. googlevideo throttles un-ranged GETs, so when yt-dlp
+    reports an http_chunk_size the file is fetched as consecutive Range requests.
+    """
+    if not http_chunk_size:
+        async with client.stream("GET", url, headers=headers) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(chunk_size):
+                yield chunk
+        return
+    start = 0
+    while True:
+        range_headers = {**headers, "Range": f"bytes={start}-{start + http_chunk_size - 1}"}
+        async with client.stream("GET", url, headers=range_headers) as response:
+            if response.status_code == 416 and start > 0:
+                return  # size was an exact multiple of the range and no total was sent
+            response.raise_for_status()
+            received = 0
+            async for chunk in response.aiter_bytes(chunk_size):
+                received += len(chunk)
+                yield chunk
+            total = response.headers.get("content-range", "").rpartition("/")[2]
+        if response.status_code != 206:
+            return  # server ignored Range and sent the whole file
+        start += received
+        if received < http_chunk_size or (total.isdigit() and start >= int(total)):
+            return
+
+async def pipe_chunks(source, max_chunks: int = 8):
+    """
+    Async iterable body for httpx (sent with chunked transfer-encoding).
+    A producer task keeps pulling the download while the upload sends, so
+    the two overlap; the bounded queue stalls the producer (and so the
+    download) when the upload falls behind.
+    """
+    queue = asyncio.Queue(maxsize=max_chunks)
+
+    async def produce():
+        try:
+            async for chunk in source:
+                await queue.put(chunk)
+            await queue.put(None)
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await source.aclose()
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (item := await queue.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        producer.cancel()
+
 @app.post("/extract_video_id")
-def extract_video_id(payload: dict = Body(..., description="JSON with a 'video_url' key")):
+async def extract_video_id(payload: dict = Body(..., description="JSON with a 'video_url' key")):
     video_url = payload.get("video_url")
     if not video_url:
         raise HTTPException(status_code=400, detail="Missing 'video_url' in request body")
-    m = re.search(r"(?:v=|youtu\.be/)([^&]+)", video_url)
+    m = VIDEO_ID_RE.search(video_url)
     if not m:
         raise HTTPException(status_code=400, detail="Invalid YouTube URL")
     return {"video_id": m.group(1)}
 
-@app.get("/metadata")
-def get_video_metadata(video_id: str = Query(..., description="YouTube video ID")):
-    if not YOUTUBE_API_KEY:
-        raise HTTPException(status_code=500, detail="YOUTUBE_API_KEY not set")
-    response = requests.get(
-        "https://www.googleapis.com/youtube/v3/videos",
-        params={"part": "snippet,contentDetails,statistics", "id": video_id, "key": YOUTUBE_API_KEY}
-    )
-    if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code, detail=response.text)
-    items = response.json().get("items", [])
-    if not items:
-        raise HTTPException(status_code=404, detail="Video not found")
-    item = items[0]
+# ISO 8601 durations as returned by videos.list: PT#H#M#S, P#DT..., P0D for live
+DURATION_RE = re.compile(r"P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?")
+
+def duration_seconds(iso: str):
+    m = DURATION_RE.fullmatch(iso)
+    if not m:
+        return None
+    d, h, mins, sec = (int(g) for g in m.groups(default="0"))
+    return ((d * 24 + h) * 60 + mins) * 60 + sec
+
+def parse_metadata_item(item: dict) -> dict:
     return {
         "title": item["snippet"]["title"],
         "description": item["snippet"]["description"],
         "tags": item["snippet"].get("tags", []),
         "duration": item["contentDetails"]["duration"],
+        # Parsed once here and cached with the rest of the metadata
+        "duration_seconds": duration_seconds(item["contentDetails"]["duration"]),
         "stats": item.get("statistics", {})
     }
 
+async def fetch_metadata_batch(video_ids: list) -> dict:
+    # videos.list takes up to 50 ids per call for the same quota cost
+    chunks = [video_ids[i:i + 50] for i in range(0, len(video_ids), 50)]
+    responses = await asyncio.gather(*[
+        get_with_retry(
+            "https://www.googleapis.com/youtube/v3/videos",
+            params={
+                "part": "snippet,contentDetails,statistics",
+                "id": ",".join(chunk),
+                # Partial response: skip thumbnails/localized/etc. we never read
+                "fields": "items(id,snippet(title,description,tags),contentDetails(duration),statistics)",
+                "key": YOUTUBE_API_KEY,
+            }
+        )
+        for chunk in chunks
+    ])
+    found = {}
+    for response in responses:
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail=response.text)
+        for item in orjson.loads(response.content).get("items", []):
+            found[item["id"]] = parse_metadata_item(item)
+    return found
+
+async def refresh_metadata_batch(video_ids: list) -> dict:
+    found = await fetch_metadata_batch(video_ids)
+    await asyncio.gather(*[
+        cache_set(f"yt:meta:{vid}", meta, METADATA_TTL, METADATA_FRESH)
+        for vid, meta in found.items()
+    ], *[
+        remember_stale(f"yt:meta:stale:{vid}", meta)
+        for vid, meta in found.items()
+    ])
+    return found
+
+async def refresh_metadata_or_stale(video_ids: list, response: Response = None) -> dict:
+    try:
+        return await refresh_metadata_batch(video_ids)
+    except Exception:
+        if not ALLOW_STALE:
+            raise
+        stale = await asyncio.gather(*[kv_get(f"yt:meta:stale:{vid}", STALE_CACHE) for vid in video_ids])
+        if any(meta is None for meta in stale):
+            raise
+        mark_stale(response)
+        return dict(zip(video_ids, stale))
+
+async def cached_metadata_batch(video_ids: list, refresh: bool = False, response: Response = None) -> dict:
+    """Return {video_id: metadata or None}; only cache misses hit the API."""
+    if not YOUTUBE_API_KEY:
+        raise HTTPException(status_code=500, detail="YOUTUBE_API_KEY not set")
+    video_ids = list(dict.fromkeys(video_ids))
+    if refresh:
+        hits = [None] * len(video_ids)
+    else:
+        hits = await asyncio.gather(*[cache_get(f"yt:meta:{vid}") for vid in video_ids])
+    result, missing, stale = {}, [], []
+    for vid, hit in zip(video_ids, hits):
+        if hit is None:
+            missing.append(vid)
+            continue
+        result[vid], is_stale = hit
+        if is_stale:
+            stale.append(vid)
+    if stale:
+        claimed = await claim_fill_locks([f"yt:meta:{vid}" for vid in stale])
+        if claimed:
+            ids = [key.removeprefix("yt:meta:") for key, _ in claimed]
+            spawn(release_after([lock for _, lock in claimed], refresh_metadata_batch(ids)))
+    if missing:
+        async with contextlib.AsyncExitStack() as stack:
+            # Sorted acquisition so overlapping batches can't deadlock
+            for vid in sorted(missing):
+                await stack.enter_async_context(fill_lock(f"yt:meta:{vid}"))
+            if not refresh:
+                # Another request may have filled these while we waited
+                rechecked = await asyncio.gather(*[cache_get(f"yt:meta:{vid}") for vid in missing])
+                for vid, hit in zip(list(missing), rechecked):
+                    if hit is not None:
+                        result[vid] = hit[0]
+                        missing.remove(vid)
+            if missing:
+                found = await refresh_metadata_or_stale(missing, response)
+                for vid in missing:
+                    result[vid] = found.get(vid)
+    return {vid: result[vid] for vid in video_ids}
+
+async def cached_metadata(video_id: str, refresh: bool = False, response: Response = None) -> dict:
+    meta = (await cached_metadata_batch([video_id], refresh=refresh, response=response))[video_id]
+    if meta is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+    return meta
+
+# youtube-transcript-api >= 1.0 is instance-based (get_transcript was removed)
+ytt_api = YouTubeTranscriptApi()
+
+async def refresh_captions(video_id: str, lang: str) -> dict:
+    fetched = await asyncio.to_thread(ytt_api.fetch, video_id, languages=[lang])
+    segments = fetched.to_raw_data()
+    captions = {"captions": join_segments(segments), "segments": segments}
+    await cache_set(f"yt:caps:{video_id}:{lang}", captions, CAPTIONS_TTL, CAPTIONS_FRESH)
+    await remember_stale(f"yt:caps:stale:{video_id}:{lang}", captions)
+    return captions
+
+async def refresh_captions_or_stale(video_id: str, lang: str, response: Response = None) -> dict:
+    try:
+        return await refresh_captions(video_id, lang)
+    except Exception:
+        if not ALLOW_STALE:
+            raise
+        captions = await kv_get(f"yt:caps:stale:{video_id}:{lang}", STALE_CACHE)
+        if captions is None:
+            raise
+        mark_stale(response)
+        return captions
+
+async def cached_captions(video_id: str, lang: str = "en", response: Response = None) -> dict:
+    key = f"yt:caps:{video_id}:{lang}"
+    hit = await cache_get(key)
+    if hit is None:
+        async with fill_lock(key):
+            hit = await cache_get(key)
+            if hit is None:
+                return await refresh_captions_or_stale(video_id, lang, response)
+    captions, is_stale = hit
+    if is_stale:
+        claimed = await claim_fill_locks([key])
+        if claimed:
+            spawn(release_after([claimed[0][1]], refresh_captions(video_id, lang)))
+    return captions
+
+@app.get("/metadata")
+async def get_video_metadata(response: Response, video_id: str = Query(..., description="YouTube video ID")):
+    return await cached_metadata(video_id, response=response)
+
+@app.get("/metadata/{video_id}")
+async def get_video_metadata_by_id(
+    video_id: str,
+    response: Response,
+    refresh: bool = Query(False, description="Bypass and overwrite the cached entry")
+):
+    return await cached_metadata(video_id, refresh=refresh, response=response)
+
+# Caps one request at 10 concurrent videos.list calls and 500 fill locks
+MAX_BATCH_IDS = 500
+
+@app.post("/metadata/batch")
+async def get_video_metadata_batch(response: Response, payload: dict = Body(..., description="JSON with a 'video_ids' list")):
+    video_ids = payload.get("video_ids")
+    if not isinstance(video_ids, list) or not video_ids or not all(isinstance(v, str) for v in video_ids):
+        raise HTTPException(status_code=400, detail="'video_ids' must be a non-empty list of strings")
+    if len(video_ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} 'video_ids' per request")
+    return await cached_metadata_batch(video_ids, response=response)
+
+def use_webhook() -> bool:
+    return bool(WEBHOOK_SECRET_TOKEN and PUBLIC_BASE_URL)
+
+async def kv_set(key: str, value, ttl: int, local: TTLCache):
+    # Redis when available so any instance can read it back, else this process
+    if r is not None:
+        try:
+            await r.set(key, orjson.dumps(value), ex=ttl)
+            return
+        except redis.RedisError:
+            pass
+    local[key] = value
+
+async def kv_delete(key: str, local: TTLCache):
+    if r is not None:
+        try:
+            await r.delete(key)
+        except redis.RedisError:
+            pass
+    local.pop(key, None)
+
+async def kv_get(key: str, local: TTLCache):
+    if r is not None:
+        try:
+            raw = await r.get(key)
+            if raw is not None:
+                return orjson.loads(raw)
+        except redis.RedisError:
+            pass
+    return local.get(key)
+
+async def save_transcript(tid: str, status_resp: dict):
+    # Keep only what is served: the raw response also carries the per-word
+    # 'words' array, which runs to megabytes for long audio
+    completed = status_resp.get("status") == "completed"
+    record = {
+        "status": status_resp.get("status"),
+        "error": status_resp.get("error"),
+        "result": format_transcript(status_resp) if completed else None,
+    }
+    await kv_set(f"tx:transcript:{tid}", record, TRANSCRIPT_TTL, transcripts)
+    if not completed:
+        return
+    video_id = await kv_get(f"tx:video:{tid}", transcript_videos)
+    if video_id:
+        await kv_set(f"tx:done:{video_id}", record["result"], TX_DONE_TTL, done_transcripts)
+
+def stored_result(record: dict) -> dict:
+    # Records saved before the compact format are raw AssemblyAI responses
+    return record["result"] if "result" in record else format_transcript(record)
+
+async def load_transcript(tid: str):
+    return await kv_get(f"tx:transcript:{tid}", transcripts)
+
+async def load_done_transcript(video_id: str):
+    return await kv_get(f"tx:done:{video_id}", done_transcripts)
+
+async def submit_audio(video_id: str) -> str:
+    """Stream audio from YouTube into an AssemblyAI upload and queue a transcript job."""
+    # yt-dlp only resolves the stream URL; the bytes go from YouTube straight
+    # into the upload, no temp file
+    audio_url, audio_headers, http_chunk_size = await run_in_ydl_pool(resolve_audio, video_id)
+    upload_resp = orjson.loads((await client.post(
+        "https://api.assemblyai.com/v2/upload",
+        headers={"authorization": ASSEMBLYAI_API_KEY},
+        content=pipe_chunks(download_chunks(audio_url, audio_headers, http_chunk_size))
+    )).content)
+    upload_url = upload_resp.get("upload_url")
+    if not upload_url:
+        raise Exception("AssemblyAI upload error")
+    # Request transcription
+    transcript_body = {"audio_url": upload_url, "speaker_labels": True}
+    if use_webhook():
+        transcript_body["webhook_url"] = f"{PUBLIC_BASE_URL}/webhooks/assemblyai/{WEBHOOK_SECRET_TOKEN}"
+    transcript_req = orjson.loads((await client.post(
+        "https://api.assemblyai.com/v2/transcript",
+        headers={"authorization": ASSEMBLYAI_API_KEY, "content-type": "application/json"},
+        content=orjson.dumps(transcript_body)
+    )).content)
+    tid = transcript_req.get("id")
+    if not tid:
+        raise Exception("Transcription request failed")
+    await kv_set(f"tx:video:{tid}", video_id, TRANSCRIPT_TTL, transcript_videos)
+    await kv_set(f"tx:result:{video_id}", tid, TRANSCRIPT_TTL, active_jobs)
+    await add_pending(tid)
+    return tid
+
+async def extend_lock(lock_key: str, token: str):
+    # Keep the lock alive for as long as this holder is downloading/uploading
+    while True:
+        await asyncio.sleep(TX_LOCK_TTL / 3)
+        try:
+            if await r.get(lock_key) != token.encode():
+                return
+            await r.expire(lock_key, TX_LOCK_TTL)
+        except redis.RedisError:
+            pass
+
+async def submit_audio_once(video_id: str) -> str:
+    """
+    Single-flight per video until the job finishes: tx:result:{video_id} maps a
+    video to its unfinished job, and across instances one request holds
+    tx:lock:{video_id} while it submits; others wait for the id it publishes.
+    """
+    result_key = f"tx:result:{video_id}"
+    tid = await kv_get(result_key, active_jobs)
+    if tid is not None:
+        return tid
+    if r is None:
+        return await submit_audio(video_id)
+    lock_key = f"tx:lock:{video_id}"
+    token = secrets.token_hex(8)
+    while True:
+        tid = await kv_get(result_key, active_jobs)
+        if tid is not None:
+            return tid
+        try:
+            got = await r.set(lock_key, token, nx=True, ex=TX_LOCK_TTL)
+        except redis.RedisError:
+            return await submit_audio(video_id)
+        if got:
+            renewer = asyncio.create_task(extend_lock(lock_key, token))
+            try:
+                return await submit_audio(video_id)
+            finally:
+                renewer.cancel()
+                try:
+                    if await r.get(lock_key) == token.encode():
+                        await r.delete(lock_key)
+                except redis.RedisError:
+                    pass
+        # The holder renews its lock while alive; if it dies the lock expires
+        # and one of the waiters takes over
+        await asyncio.sleep(1)
+
+def drop_flight(video_id: str, flight: dict):
+    if inflight_submissions.get(video_id) is flight:
+        del inflight_submissions[video_id]
+
+async def submit_transcription(video_id: str) -> str:
+    # In-process single-flight on top of the Redis lock: concurrent requests on
+    # this instance share one task. It is shielded from any single waiter and
+    # only cancelled once every waiter has gone away.
+    flight = inflight_submissions.get(video_id)
+    if flight is None or flight["task"].done() or flight["task"].cancelling():
+        # Never join a flight that has finished or is being torn down
+        task = asyncio.create_task(submit_audio_once(video_id))
+        flight = inflight_submissions[video_id] = {"task": task, "waiters": 0}
+        task.add_done_callback(lambda _, flight=flight: drop_flight(video_id, flight))
+    flight["waiters"] += 1
+    try:
+        return await asyncio.shield(flight["task"])
+    except asyncio.CancelledError:
+        if flight["waiters"] == 1:
+            # Unregister first so a request arriving during the task's cleanup
+            # starts a new flight instead of joining this one
+            drop_flight(video_id, flight)
+            flight["task"].cancel()
+        raise
+    finally:
+        flight["waiters"] -= 1
+
+async def add_pending(tid: str):
+    if r is not None:
+        try:
+            await r.zadd("tx:pending", {tid: time.time()})
+            return
+        except redis.RedisError:
+            pass
+    pending_jobs[tid] = time.time()
+
+async def remove_pending(tid: str):
+    if r is not None:
+        try:
+            await r.zrem("tx:pending", tid)
+        except redis.RedisError:
+            pass
+    pending_jobs.pop(tid, None)
+
+async def stale_pending(older_than: float) -> dict:
+    """Return {transcript_id: submitted_at} for jobs pending at least older_than seconds."""
+    cutoff = time.time() - older_than
+    tids = {tid: submitted for tid, submitted in pending_jobs.items() if submitted <= cutoff}
+    if r is not None:
+        try:
+            for tid, submitted in await r.zrangebyscore("tx:pending", 0, cutoff, withscores=True):
+                tids[tid.decode()] = submitted
+        except redis.RedisError:
+            pass
+    return tids
+
+async def is_pending(tid: str) -> bool:
+    if tid in pending_jobs:
+        return True
+    if r is not None:
+        try:
+            return await r.zscore("tx:pending", tid) is not None
+        except redis.RedisError:
+            pass
+    return False
+
+async def fetch_transcript_status(tid: str) -> dict:
+    return orjson.loads((await get_with_retry(
+        f"https://api.assemblyai.com/v2/transcript/{tid}",
+        headers={"authorization": ASSEMBLYAI_API_KEY}
+    )).content)
+
+async def finalize(tid: str, status_resp: dict):
+    """Record a finished job exactly once; shared by the webhook and the stale-job poller."""
+    if status_resp.get("status") not in ("completed", "error"):
+        return
+    previous = await load_transcript(tid)
+    if previous is None or previous.get("status") not in ("completed", "error"):
+        await save_transcript(tid, status_resp)
+    await release_job(tid)
+
+async def release_job(tid: str):
+    # Stop tracking the job; the next request for its video may submit again
+    # (a completed job is served from tx:done by then)
+    await remove_pending(tid)
+    video_id = await kv_get(f"tx:video:{tid}", transcript_videos)
+    if video_id and await kv_get(f"tx:result:{video_id}", active_jobs) == tid:
+        await kv_delete(f"tx:result:{video_id}", active_jobs)
+
+async def poll_stale_jobs():
+    # One sweep task per instance replaces a poll loop per request; with
+    # webhooks it only picks up jobs whose delivery never arrived
+    while True:
+        await asyncio.sleep(TX_POLL_INTERVAL)
+        try:
+            tids = await stale_pending(TX_STALE_AFTER)
+        except Exception as e:
+            logger.warning("Stale-job sweep failed to list pending jobs: %r", e)
+            continue
+        expired_before = time.time() - TRANSCRIPT_TTL
+        for tid, submitted in tids.items():
+            try:
+                if submitted < expired_before:
+                    # Never reached a terminal status (deleted job, bad id,
+                    # auth error body); stop polling it
+                    await release_job(tid)
+                    continue
+                status_resp = await fetch_transcript_status(tid)
+                if status_resp.get("status") not in ("queued", "processing", "completed", "error"):
+                    # e.g. an auth error body: finalize ignores it, so surface it here
+                    logger.warning("Unexpected AssemblyAI status for %s: %r", tid, status_resp)
+                await finalize(tid, status_resp)
+            except Exception as e:
+                # Retried on the next sweep
+                logger.warning("Stale-job poll for %s failed: %r", tid, e)
+
+@app.on_event("startup")
+async def start_stale_job_poller():
+    global stale_job_poller
+    stale_job_poller = asyncio.create_task(poll_stale_jobs())
+
+@app.on_event("shutdown")
+async def stop_stale_job_poller():
+    if stale_job_poller is not None:
+        stale_job_poller.cancel()
+
+async def transcribe_audio(video_id: str) -> dict:
+    done = await load_done_transcript(video_id)
+    if done is not None:
+        return done
+    tid = await submit_transcription(video_id)
+    finished = await load_transcript(tid)
+    if finished is not None and finished.get("status") == "completed":
+        return stored_result(finished)
+    # Result arrives via the webhook or the stale-job poller; don't hold the worker
+    return {"transcript_id": tid}
+
+def captions_transcript(captions: dict) -> dict:
+    return {
+        "transcript": captions["captions"],
+        "paragraphs": [],
+        "speaker_labels": [],
+        "source": "youtube_captions"
+    }
+
+async def captions_transcript_for(video_id: str) -> dict:
+    return captions_transcript(await cached_captions(video_id))
+
+async def first_success(*coros, is_final=lambda result: True):
+    """
+    Run coroutines concurrently; return the first result that isn't an error
+    and cancel the rest. A result failing is_final is only a fallback: it is
+    returned if every other coroutine fails.
+    """
+    pending = {asyncio.create_task(c) for c in coros}
+    error = fallback = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled():
+                    # A cancelled branch is a failure of that branch, not of the request
+                    error = error or Exception("transcription task was cancelled")
+                    continue
+                if task.exception() is not None:
+                    error = task.exception()
+                elif is_final(task.result()):
+                    return task.result()
+                elif fallback is None:
+                    fallback = task
+        if fallback is not None:
+            return fallback.result()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
 @app.post("/transcribe")
-def download_and_transcribe_audio(
+async def download_and_transcribe_audio(
     payload: dict = Body(..., description="JSON with a 'video_id' key")
 ):
     """
-    Attempt to download audio via yt_dlp and send to AssemblyAI.
-    If download fails (e.g., bot-check), fallback to YouTube captions.
-    Returns transcript text, paragraphs, speaker_labels, and a 'source' key.
+    Race YouTube captions against streaming audio from yt-dlp into AssemblyAI
+    and return whichever succeeds first (captions usually win within a second;
+    audio covers videos without captions or blocked caption scraping).
+    With PREFER_CAPTIONS=true, audio is only tried when captions are missing.
+    Captions come back as transcript text with a 'source' key; the audio path
+    returns {"transcript_id": ...} as soon as the job is queued; fetch the
+    result later from GET /transcribe/{transcript_id}.
+    Concurrent requests for the same video share a single download and job,
+    and a video transcribed in the last 30 days is returned from cache.
     """
     video_id = payload.get("video_id")
     if not video_id:
         raise HTTPException(status_code=400, detail="Missing 'video_id' in request body")
     if not ASSEMBLYAI_API_KEY:
         raise HTTPException(status_code=500, detail="ASSEMBLYAI_API_KEY not set")
-    # Prepare output path
-    output_path = f"/tmp/{uuid.uuid4()}.m4a"
-    ydl_opts = {
-        'format': 'bestaudio[ext=m4a]',
-        'outtmpl': output_path,
-        'quiet': True,
-        'nopart': True,
-    }
+    done = await load_done_transcript(video_id)
+    if done is not None:
+        return done
     try:
-        # Try audio download via yt_dlp Python API
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([f"https://youtu.be/{video_id}"])
-        # Upload to AssemblyAI
-        with open(output_path, "rb") as audio_file:
-            upload_resp = requests.post(
-                "https://api.assemblyai.com/v2/upload",
-                headers={"authorization": ASSEMBLYAI_API_KEY},
-                data=audio_file
-            ).json()
-        upload_url = upload_resp.get("upload_url")
-        if not upload_url:
-            raise Exception("AssemblyAI upload error")
-        # Request transcription
-        transcript_req = requests.post(
-            "https://api.assemblyai.com/v2/transcript",
-            headers={"authorization": ASSEMBLYAI_API_KEY},
-            json={"audio_url": upload_url, "speaker_labels": True}
-        ).json()
-        tid = transcript_req.get("id")
-        if not tid:
-            raise Exception("Transcription request failed")
-        # Poll until complete
-        while True:
-            status_resp = requests.get(
-                f"https://api.assemblyai.com/v2/transcript/{tid}",
-                headers={"authorization": ASSEMBLYAI_API_KEY}
-            ).json()
-            if status_resp.get("status") == "completed":
-                return {
-                    "transcript": status_resp.get("text"),
-                    "paragraphs": status_resp.get("paragraphs", []),
-                    "speaker_labels": status_resp.get("utterances", []),
-                    "source": "assemblyai_audio"
-                }
-            if status_resp.get("status") == "error":
-                raise Exception("Transcription failed")
-            time.sleep(5)
+        if PREFER_CAPTIONS:
+            try:
+                return await captions_transcript_for(video_id)
+            except Exception:
+                return await transcribe_audio(video_id)
+        # A bare {"transcript_id"} from the audio side (new or joined job)
+        # only wins once captions have failed
+        return await first_success(
+            captions_transcript_for(video_id),
+            transcribe_audio(video_id),
+            is_final=lambda result: "transcript" in result,
+        )
     except Exception as e:
-        # Fallback to captions
-        try:
-            segments = YouTubeTranscriptApi.get_transcript(video_id)
-            full_text = " ".join(seg['text'] for seg in segments)
-            return {
-                "transcript": full_text,
-                "paragraphs": [],
-                "speaker_labels": [],
-                "source": "youtube_captions"
-            }
-        except Exception as ce:
-            raise HTTPException(status_code=500, detail=f"All transcription methods failed: {ce}")@app.get("/captions")
-def fallback_to_captions(video_id: str = Query(..., description="YouTube video ID")):
+        raise HTTPException(status_code=500, detail=f"All transcription methods failed: {e}")
+
+@app.get("/transcribe/{transcript_id}")
+async def get_transcription_result(transcript_id: str):
+    record = await load_transcript(transcript_id)
+    if record is None:
+        if not await is_pending(transcript_id):
+            raise HTTPException(status_code=404, detail="Unknown transcript_id")
+        return {"transcript_id": transcript_id, "status": "processing"}
+    if record.get("status") == "error":
+        raise HTTPException(status_code=500, detail=f"Transcription failed: {record.get('error')}")
+    return stored_result(record)
+
+@app.post("/webhooks/assemblyai/{secret}")
+async def assemblyai_webhook(secret: str, request: Request):
+    if not WEBHOOK_SECRET_TOKEN or not secrets.compare_digest(secret, WEBHOOK_SECRET_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid webhook secret")
+    try:
+        payload = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON in webhook body")
+    tid = payload.get("transcript_id")
+    if not tid:
+        raise HTTPException(status_code=400, detail="Missing 'transcript_id' in webhook body")
+    # The notification only carries id + status; fetch the full transcript once
+    await finalize(tid, await fetch_transcript_status(tid))
+    return {"received": True}
+
+@app.get("/captions")
+async def fallback_to_captions(
+    response: Response,
+    video_id: str = Query(..., description="YouTube video ID"),
+    lang: str = Query("en", description="Caption language code")
+):
     try:
-        segments = YouTubeTranscriptApi.get_transcript(video_id)
+        return await cached_captions(video_id, lang, response)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Captions error: {e}")
-    full_text = " ".join(seg['text'] for seg in segments)
-    return {"captions": full_text, "segments": segments}
+
+def error_detail(e: Exception) -> dict:
+    return {"error": e.detail if isinstance(e, HTTPException) else str(e)}
+
+@app.post("/summarize_ready/{video_id}")
+async def prepare_summary_inputs(video_id: str):
+    """
+    Gather metadata, captions and the audio transcript concurrently.
+    Each part is returned independently; a failed part carries an 'error' key.
+    The transcript part is the cached transcript or a transcript_id to fetch
+    later from GET /transcribe/{transcript_id}.
+    """
+    async def transcript_part():
+        if not ASSEMBLYAI_API_KEY:
+            raise HTTPException(status_code=500, detail="ASSEMBLYAI_API_KEY not set")
+        return await transcribe_audio(video_id)
+
+    meta, caps, trans = await asyncio.gather(
+        cached_metadata(video_id),
+        cached_captions(video_id),
+        transcript_part(),
+        return_exceptions=True,
+    )
+    return {
+        "video_id": video_id,
+        "metadata": error_detail(meta) if isinstance(meta, Exception) else meta,
+        "captions": error_detail(caps) if isinstance(caps, Exception) else caps,
+        "transcript": error_detail(trans) if isinstance(trans, Exception) else trans,
+    }
 
 @app.post("/summarize")
-def generate_video_summary(payload: dict = Body(..., description="All gathered data for summarization")):
+async def generate_video_summary(payload: dict = Body(..., description="All gathered data for summarization")):
     return payload